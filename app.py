@@ -1,10 +1,16 @@
 import streamlit as st
 import sqlite3
 import pandas as pd
+import numpy as np
 import json
 import os
-import re
+import pickle
+import threading
+import time
 import concurrent.futures
+from datetime import datetime, timezone
+
+from db_bootstrap import preprocess
 
 try:
     from streamlit_ace import st_ace
@@ -49,22 +55,44 @@ st.markdown("""
 
 DB_FILE = 'review.db'
 ANSWERS_FILE = 'answers.json'
+ANSWERS_CACHE_FILE = 'answers.pkl'  # answers.json 解析结果的缓存
 SQL_DIR = 'school'
 SQL_FILES = ['STUDENTS.sql', 'TEACHERS.sql', 'COURSES.sql', 'CHOICES.sql']
-
-def get_connection():
-    return sqlite3.connect(DB_FILE)
+QUERY_WORKERS = 8  # 参考答案查询线程数（所有会话共用）
+QUERY_TIMEOUT_GRACE = 0.5  # 等待查询结果时在超时时间之外额外等待的秒数
+# 提交记录缓冲条数，达到后批量写入。
+# 注意：Streamlit 没有会话结束的回调，缓冲区只存在于 st.session_state 中；
+# 关闭页面、会话过期或服务重启时，尚未写入的错误提交（最多 HISTORY_FLUSH_SIZE - 1 条）会丢失。
+# 正确提交与切换题目时会立即写入，因此这里取较小的值以缩小丢失窗口。
+HISTORY_FLUSH_SIZE = 3
+
+@st.cache_resource
+def get_conn():
+    """进程内共享的读写连接，只用于写入（避免每次 rerun 重复建立连接）"""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -65536;")
+    conn.execute("PRAGMA foreign_keys = ON;")
+    return conn
+
+@st.cache_resource
+def get_write_lock():
+    """保护共享连接上的写事务：各会话线程共用同一连接，不加锁时一个会话的提交/回滚会波及其他会话的写入"""
+    return threading.Lock()
+
+def connect_ro():
+    """为单次读取（包括用户 SQL 与参考答案）新建只读连接：无法修改数据，且临时表、PRAGMA 等连接级状态不会泄漏到其他查询"""
+    # WAL 模式下独立连接读到的是已提交数据的快照，不会被共享连接上的写事务（如重置数据库）阻塞，也看不到其未提交的修改。
+    # 数据库文件在启动时已由读写连接（init_history_table）创建
+    return sqlite3.connect(f"file:{DB_FILE}?mode=ro", uri=True)
 
 def init_db():
     """初始化数据库"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    conn = get_conn()
     try:
-        # Enable foreign keys
-        cursor.execute("PRAGMA foreign_keys = ON;")
-        
-        # Create history table if not exists
-        cursor.execute("""
+        scripts = ["""
             CREATE TABLE IF NOT EXISTS USER_HISTORY (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 question_id INTEGER,
@@ -73,34 +101,31 @@ def init_db():
                 error_message TEXT,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             );
-        """)
+        """]
         
         for sql_file in SQL_FILES:
             file_path = os.path.join(SQL_DIR, sql_file)
             if os.path.exists(file_path):
                 with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    # Remove 'use school;'
-                    content = re.sub(r'use\s+school\s*;', '', content, flags=re.IGNORECASE)
-                    # Add IF EXISTS to DROP TABLE
-                    content = re.sub(r'drop\s+table\s+(\w+);', r'DROP TABLE IF EXISTS \1;', content, flags=re.IGNORECASE)
-                    cursor.executescript(content)
-                    conn.commit()
+                    scripts.append(preprocess(f.read()))
+        
+        # 合并为一个脚本并在单个事务中执行，只提交一次；出错时整体回滚
+        with get_write_lock(), conn:
+            conn.executescript("BEGIN;\n" + "\n".join(scripts) + "\nCOMMIT;")
         
-        # 清空缓存
-        st.cache_data.clear()
         st.success("数据库已成功初始化/重置！")
     except Exception as e:
         st.error(f"初始化失败: {e}")
     finally:
-        conn.close()
+        # 清空缓存（包括参考答案结果缓存 cached_expected）；失败时也清空，不保留重置前的缓存
+        st.cache_data.clear()
 
+@st.cache_resource
 def init_history_table():
-    """Ensure history table exists without resetting everything"""
-    conn = get_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("""
+    """Ensure history table exists without resetting everything (runs once per process)"""
+    conn = get_conn()
+    with get_write_lock(), conn:
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS USER_HISTORY (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 question_id INTEGER,
@@ -110,50 +135,78 @@ def init_history_table():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             );
         """)
-        
+
+        # 提交记录查询（按题目倒序）与已完成题目查询使用的索引
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_history_question_ts
+            ON USER_HISTORY (question_id, timestamp DESC);
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_user_history_solved
+            ON USER_HISTORY (is_correct, question_id) WHERE is_correct = 1;
+        """)
+
         # Create marked questions table
-        cursor.execute("""
+        conn.execute("""
             CREATE TABLE IF NOT EXISTS MARKED_QUESTIONS (
                 question_id INTEGER PRIMARY KEY,
                 marked_at DATETIME DEFAULT CURRENT_TIMESTAMP
             );
         """)
-        conn.commit()
-    except Exception as e:
-        st.error(f"History table init failed: {e}")
-    finally:
-        conn.close()
-
-def save_history(question_id, user_sql, is_correct, error_message=None):
-    conn = get_connection()
-    cursor = conn.cursor()
+    return True
+
+def flush_history():
+    """将会话缓冲区中的提交记录一次性批量写入数据库"""
+    buf = st.session_state.get('_history_buf')
+    if not buf:
+        return
+    conn = get_conn()
     try:
-        cursor.execute("""
-            INSERT INTO USER_HISTORY (question_id, user_sql, is_correct, error_message)
-            VALUES (?, ?, ?, ?)
-        """, (question_id, user_sql, is_correct, error_message))
-        conn.commit()
+        with get_write_lock(), conn:
+            conn.executemany("""
+                INSERT INTO USER_HISTORY (question_id, user_sql, is_correct, error_message, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            """, buf)
+        buf.clear()
     except Exception as e:
         st.error(f"Failed to save history: {e}")
-    finally:
-        conn.close()
+
+def save_history(question_id, user_sql, is_correct, error_message=None):
+    """提交记录先进入会话缓冲区，累计 HISTORY_FLUSH_SIZE 条、提交正确或切换题目时批量落库（会话结束时不会落库）"""
+    buf = st.session_state.setdefault('_history_buf', [])
+    # 在提交时刻记录时间（与 CURRENT_TIMESTAMP 相同的 UTC 格式），而不是落库时刻
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    buf.append((question_id, user_sql, is_correct, error_message, timestamp))
+    if is_correct or len(buf) >= HISTORY_FLUSH_SIZE:
+        flush_history()
+    if is_correct:
+        # 已完成题目集合发生变化，使缓存失效
+        get_solved_questions.clear()
 
 def get_history(question_id):
-    conn = get_connection()
+    """返回 (user_sql, is_correct, error_message, timestamp) 元组列表"""
+    conn = connect_ro()
     try:
-        df = pd.read_sql_query(
+        cursor = conn.execute(
             "SELECT user_sql, is_correct, error_message, timestamp FROM USER_HISTORY WHERE question_id = ? ORDER BY timestamp DESC",
-            conn,
-            params=(question_id,)
+            (question_id,)
         )
-        return df
+        rows = cursor.fetchall()
     except Exception:
-        return pd.DataFrame()
+        rows = []
     finally:
         conn.close()
-
+    # 合并尚未落库的缓冲记录（最新的在前）
+    pending = [
+        (hist_sql, hist_correct, hist_error, hist_time)
+        for hist_qid, hist_sql, hist_correct, hist_error, hist_time in reversed(st.session_state.get('_history_buf', []))
+        if hist_qid == question_id
+    ]
+    return pending + rows
+
+@st.cache_data(ttl=60)
 def get_solved_questions():
-    conn = get_connection()
+    conn = connect_ro()
     try:
         # Get distinct question_ids where is_correct is true
         cursor = conn.cursor()
@@ -167,7 +220,7 @@ def get_solved_questions():
 
 def get_marked_questions():
     """获取所有被标记的题目ID"""
-    conn = get_connection()
+    conn = connect_ro()
     try:
         cursor = conn.cursor()
         cursor.execute("SELECT question_id FROM MARKED_QUESTIONS")
@@ -180,70 +233,291 @@ def get_marked_questions():
 
 def toggle_question_mark(question_id):
     """切换题目的标记状态"""
-    conn = get_connection()
-    cursor = conn.cursor()
+    conn = get_conn()
     try:
-        # Check if already marked
-        cursor.execute("SELECT COUNT(*) FROM MARKED_QUESTIONS WHERE question_id = ?", (question_id,))
-        if cursor.fetchone()[0] > 0:
-            # Remove mark
-            cursor.execute("DELETE FROM MARKED_QUESTIONS WHERE question_id = ?", (question_id,))
-        else:
-            # Add mark
-            cursor.execute("INSERT INTO MARKED_QUESTIONS (question_id) VALUES (?)", (question_id,))
-        conn.commit()
+        with get_write_lock(), conn:
+            cursor = conn.cursor()
+            # Check if already marked
+            cursor.execute("SELECT COUNT(*) FROM MARKED_QUESTIONS WHERE question_id = ?", (question_id,))
+            if cursor.fetchone()[0] > 0:
+                # Remove mark
+                cursor.execute("DELETE FROM MARKED_QUESTIONS WHERE question_id = ?", (question_id,))
+            else:
+                # Add mark
+                cursor.execute("INSERT INTO MARKED_QUESTIONS (question_id) VALUES (?)", (question_id,))
     except Exception as e:
         st.error(f"Failed to toggle mark: {e}")
-    finally:
-        conn.close()
 
-def load_questions():
+def _answers_source_key():
+    """answers.json 的 (修改时间纳秒, 文件大小)，用于判断缓存是否对应当前文件"""
+    stat = os.stat(ANSWERS_FILE)
+    return stat.st_mtime_ns, stat.st_size
+
+def _read_answers_cache(source_key):
+    """读取预先解析好的题目缓存；缓存不存在、损坏或不对应当前 answers.json 时返回 None"""
+    try:
+        with open(ANSWERS_CACHE_FILE, 'rb') as f:
+            cached = pickle.load(f)
+        if cached["source"] == source_key:
+            return cached["questions"]
+    except Exception:
+        # 缓存只是加速手段，任何读取问题都回退到解析 JSON
+        pass
+    return None
+
+def _write_answers_cache(source_key, questions):
+    """写入题目缓存（先写临时文件再替换，避免其他会话读到不完整的文件）"""
+    tmp_file = f"{ANSWERS_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({"source": source_key, "questions": questions}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, ANSWERS_CACHE_FILE)
+    except OSError:
+        pass
+
+@st.cache_data
+def load_questions(mtime=None):
+    """读取题目配置（按文件修改时间缓存，文件变更后自动重新加载）"""
+    if mtime is None:
+        return []
+
+    # 冷启动时优先使用预先解析好的缓存文件
+    source_key = _answers_source_key()
+    questions = _read_answers_cache(source_key)
+    if questions is not None:
+        return questions
+
     questions = []
     
     # Load questions and answers from JSON
-    if os.path.exists(ANSWERS_FILE):
-        with open(ANSWERS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            for idx, item in enumerate(data):
-                questions.append({
-                    "id": idx,
-                    "title": item.get("question", ""),
-                    "description": item.get("question", ""),
-                    "answer_sql": item.get("sql", "")
-                })
-            
+    with open(ANSWERS_FILE, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+        for idx, item in enumerate(data):
+            questions.append({
+                "id": idx,
+                "title": item.get("question", ""),
+                "description": item.get("question", ""),
+                "answer_sql": item.get("sql", "")
+            })
+
+    _write_answers_cache(source_key, questions)
     return questions
 
-def run_query(query):
-    conn = get_connection()
+def run_query(query, max_rows):
+    """执行查询，只从 SQLite 读取前 max_rows 行（仅用于展示；完整结果见 run_query_summary）"""
+    conn = connect_ro()
     try:
-        df = pd.read_sql_query(query, conn)
+        cursor = conn.execute(query)
+        if cursor.description is None:
+            return None, "该语句没有返回结果集"
+        columns = [desc[0] for desc in cursor.description]
+        df = pd.DataFrame.from_records(cursor.fetchmany(max_rows), columns=columns)
         return df, None
     except Exception as e:
         return None, str(e)
     finally:
         conn.close()
 
-def run_query_with_timeout(query, timeout_seconds=2):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(run_query, query)
-        try:
-            return future.result(timeout=timeout_seconds)
-        except concurrent.futures.TimeoutError:
+def run_query_stream(conn, query, chunksize=4096):
+    """在给定连接上分块执行查询，返回 (DataFrame 分块迭代器, 错误信息)"""
+    try:
+        cursor = conn.execute(query)
+    except Exception as e:
+        return None, str(e)
+    if cursor.description is None:
+        return None, "该语句没有返回结果集"
+    columns = [desc[0] for desc in cursor.description]
+
+    def chunks():
+        # 第一块总会返回（结果为空时是带列名的空表），最后一块可能为空
+        while True:
+            rows = cursor.fetchmany(chunksize)
+            yield pd.DataFrame.from_records(rows, columns=columns)
+            if len(rows) < chunksize:
+                break
+
+    return chunks(), None
+
+def run_query_summary(query, preview_rows=11):
+    """流式读取完整结果，返回 (前 preview_rows 行, 总行数, 结果指纹, 错误信息)"""
+    # 每次只持有一个分块，并把它折叠进固定大小的指纹，峰值内存取决于分块大小而不是结果行数
+    try:
+        conn = connect_ro()
+    except Exception as e:
+        return None, 0, None, str(e)
+    preview = None
+    fingerprint = EMPTY_FINGERPRINT
+    try:
+        chunks, error = run_query_stream(conn, query)
+        if error:
+            return None, 0, None, error
+        for chunk in chunks:
+            if preview is None:
+                preview = chunk.head(preview_rows)
+            fingerprint = result_fingerprint(chunk, fingerprint)
+    except Exception as e:
+        return None, 0, None, str(e)
+    finally:
+        conn.close()
+    return preview, fingerprint[0], fingerprint, None
+
+def count_query_rows(query):
+    """统计查询结果的总行数，返回 (行数, 错误信息)（仅在用户勾选时调用）"""
+    # 去掉结尾的分号；换行包裹，避免末尾的 -- 注释吞掉右括号
+    query = query.strip().rstrip(';')
+    conn = connect_ro()
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM (\n{query}\n)").fetchone()[0], None
+    except Exception as e:
+        return None, str(e)
+    finally:
+        conn.close()
+
+@st.cache_resource
+def get_executor():
+    """后台执行查询的线程池（进程内复用，避免每次调用都创建线程）"""
+    return concurrent.futures.ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+def run_query_until(query, timeout_seconds, started):
+    """在独立连接上执行查询，开始执行 timeout_seconds 秒后由 SQLite 中断执行"""
+    # 超时从工作线程真正开始执行时算起，排队等待的时间不计入
+    deadline = time.monotonic() + timeout_seconds
+    started.set()
+    conn = None
+    try:
+        conn = connect_ro()
+        # 每执行 10000 条虚拟机指令检查一次，返回 True 时 SQLite 中断当前查询
+        conn.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+        df = pd.read_sql_query(query, conn)
+        return df, None
+    except Exception as e:
+        if time.monotonic() >= deadline:
+            # 被 progress handler 中断，按超时处理（超时结果不会被缓存）
             return None, "Timeout"
-        except Exception as e:
-            return None, str(e)
+        return None, str(e)
+    finally:
+        if conn is not None:
+            conn.close()
+
+def run_query_with_timeout(query, timeout_seconds=2):
+    started = threading.Event()
+    future = get_executor().submit(run_query_until, query, timeout_seconds, started)
+    # 先等待查询进入执行，再等待超时时间加上余量，保证 SQLite 的中断先于这里的等待超时
+    started.wait()
+    try:
+        return future.result(timeout=timeout_seconds + QUERY_TIMEOUT_GRACE)
+    except concurrent.futures.TimeoutError:
+        return None, "Timeout"
+    except Exception as e:
+        return None, str(e)
+
+class ExpectedQueryTimeout(Exception):
+    """参考答案执行超时（抛出异常以免超时结果被缓存）"""
+
+@st.cache_data(ttl=3000, show_spinner=False)
+def cached_expected(sql):
+    """执行参考答案 SQL（按 SQL 文本缓存结果）"""
+    df, error = run_query_with_timeout(sql)
+    if error == "Timeout":
+        raise ExpectedQueryTimeout()
+    return df, error
+
+def get_expected_result(sql):
+    try:
+        return cached_expected(sql)
+    except ExpectedQueryTimeout:
+        return None, "Timeout"
+
+# 结果指纹：(行数, 各行哈希之和 mod 2^64)。求和与顺序无关，因此指纹只取决于行的多重集合
+EMPTY_FINGERPRINT = (0, 0)
+_FINGERPRINT_MOD = 1 << 64
+_NULL_HASH = np.uint64(0x9E3779B97F4A7C15)  # NULL 的固定哈希，与所在列的 dtype 无关
+
+def _hash_numbers(values):
+    """数值统一转为浮点数并按 6 位小数取整后哈希，整数与等值的浮点数哈希相同"""
+    # 注意：这是绝对误差（差异在小数点后 6 位以内），不是 assert_frame_equal 的相对误差 rtol=1e-5；
+    # 恰好落在取整边界两侧的两个值会被判为不同。超过 2^53 的整数会丢失精度。
+    values = np.round(values.astype('float64'), 6) + 0.0  # + 0.0 把 -0.0 统一为 0.0
+    hashes = pd.util.hash_array(values)
+    hashes[np.isnan(values)] = _NULL_HASH
+    return hashes
+
+def _column_hashes(column):
+    """逐列向量化计算单元格哈希：NaN/None 视为 NULL，数值不区分整数与浮点数"""
+    if pd.api.types.is_numeric_dtype(column):
+        return _hash_numbers(column.to_numpy())
+    values = column.to_numpy(dtype=object)
+    nulls = pd.isna(values)
+    hashes = np.full(len(values), _NULL_HASH, dtype=np.uint64)
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == 'string':
+        hashes[~nulls] = pd.util.hash_array(values[~nulls])
+    elif kind in ('integer', 'floating', 'mixed-integer-float'):
+        hashes[~nulls] = _hash_numbers(values[~nulls])
+    elif kind != 'empty':
+        # SQLite 的列可以逐行混合类型：数值与其他值分别哈希，保证与纯数值列的结果一致
+        numeric = np.array([isinstance(v, (int, float)) for v in values], dtype=bool) & ~nulls
+        other = ~numeric & ~nulls
+        hashes[numeric] = _hash_numbers(values[numeric])
+        hashes[other] = pd.util.hash_array(values[other].astype(str).astype(object))
+    return hashes
+
+def result_fingerprint(df, fingerprint=EMPTY_FINGERPRINT):
+    """把 df 的行累加进指纹（忽略列名与行顺序）"""
+    row_count, hash_sum = fingerprint
+    row_hashes = np.zeros(len(df), dtype=np.uint64)
+    for i in range(df.shape[1]):
+        # 按列顺序混合出每行的哈希，列的位置不同哈希也不同
+        row_hashes = pd.util.hash_array(row_hashes ^ _column_hashes(df.iloc[:, i]))
+    # uint64 求和按 2^64 自然回绕
+    hash_sum = (hash_sum + int(row_hashes.sum(dtype=np.uint64))) % _FINGERPRINT_MOD
+    return row_count + len(df), hash_sum
+
+@st.cache_data(ttl=3000, show_spinner=False)
+def cached_expected_fingerprint(sql):
+    """参考答案结果的 (列数, 结果指纹)（按 SQL 文本缓存，每次提交无需重新计算）"""
+    df, error = cached_expected(sql)
+    if error:
+        return None, error
+    return (len(df.columns), result_fingerprint(df)), None
+
+def get_expected_fingerprint(sql):
+    try:
+        return cached_expected_fingerprint(sql)
+    except ExpectedQueryTimeout:
+        return None, "Timeout"
+
+def results_match(expected, user_df, user_fingerprint):
+    """O(N) 比对结果集，无需排序；expected 为 (列数, 结果指纹)，user_df 只用于比较列数"""
+    expected_cols, expected_fingerprint = expected
+    if expected_cols != len(user_df.columns):
+        return False
+    return expected_fingerprint == user_fingerprint
+
+def dedup_columns(columns):
+    """为重复列名添加 .1、.2 后缀（与 pandas 的命名方式一致）"""
+    seen = set()
+    next_suffix = {}
+    new_cols = []
+    for col in columns:
+        c = col
+        # 从该列名上次用到的后缀继续，避免每次都从 .1 开始逐个尝试
+        i = next_suffix.get(col, 1)
+        while c in seen:
+            c = f"{col}.{i}"
+            i += 1
+        next_suffix[col] = i
+        seen.add(c)
+        new_cols.append(c)
+    return new_cols
 
 @st.cache_data(ttl=300)  # 缓存5分钟
 def get_table_list():
     """获取数据库表列表（带缓存）"""
-    conn = get_connection()
+    conn = connect_ro()
     try:
-        tables = pd.read_sql_query(
-            "SELECT name FROM sqlite_master WHERE type='table';",
-            conn
-        )
-        all_tables = tables['name'].tolist()
+        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        all_tables = [row[0] for row in cursor.fetchall()]
         # Filter for desired tables (case-insensitive match)
         target_tables = {'students', 'teachers', 'courses', 'choices'}
         return [t for t in all_tables if t.lower() in target_tables]
@@ -253,28 +527,62 @@ def get_table_list():
     finally:
         conn.close()
 
-@st.cache_data(ttl=3000)
-def get_table_data(table_name):
-    """获取指定表的数据（带缓存）"""
-    conn = get_connection()
+def quote_table_name(table_name):
+    """校验表名在可预览的表列表中，并按 SQLite 标识符规则加双引号"""
+    if table_name not in get_table_list():
+        raise ValueError(f"未知的表: {table_name}")
+    return '"' + table_name.replace('"', '""') + '"'
+
+def get_data_version():
+    """数据库的数据版本号（其他连接如 reset_db.py 提交写入后才会变化）"""
+    # 必须在长期存在的共享连接上查询：新建的连接总是从初始值开始
+    return get_conn().execute("PRAGMA data_version;").fetchone()[0]
+
+# 以下两个函数出错时直接抛出异常（异常不会被缓存），由调用处显示错误
+@st.cache_data(max_entries=32)  # 只保留最近数据版本下各表的结果
+def get_table_data(table_name, data_version=None):
+    """获取指定表的前 11 行数据（多取一行用于判断是否超过 10 行，按数据版本缓存）"""
+    conn = connect_ro()
     try:
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        return df
-    except Exception as e:
-        st.error(f"读取表 {table_name} 失败: {e}")
-        return pd.DataFrame()
+        cursor = conn.execute(f"SELECT * FROM {quote_table_name(table_name)} LIMIT 11")
+        columns = [desc[0] for desc in cursor.description]
+        return pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+    finally:
+        conn.close()
+
+@st.cache_data(max_entries=32)
+def get_table_count(table_name, data_version=None):
+    """获取指定表的总行数（按数据版本缓存，仅在用户需要时调用）"""
+    conn = connect_ro()
+    try:
+        return conn.execute(f"SELECT COUNT(*) FROM {quote_table_name(table_name)}").fetchone()[0]
     finally:
         conn.close()
 
+@st.cache_data(max_entries=16)  # 只保留最近的已完成/已标记组合
+def build_question_titles(mtime, solved_ids, marked_ids):
+    """生成侧边栏题目列表（按题目文件版本与已完成/已标记集合缓存）"""
+    titles = []
+    for q in load_questions(mtime):
+        prefix = "✅ " if q['id'] in solved_ids else ""
+        marker = "⚠️ " if q['id'] in marked_ids else ""
+        titles.append(f"{marker}{prefix}{q['id'] + 1}. {q['title']}")
+    return tuple(titles)
+
 # --- 侧边栏 ---
-# Ensure history table exists on startup
-init_history_table()
+# Ensure history table exists on startup (cached: only the first run hits the DB;
+# failures raise and are therefore not cached, so the next rerun retries)
+try:
+    init_history_table()
+except Exception as e:
+    st.error(f"History table init failed: {e}")
 
 with st.sidebar.expander("功能菜单", expanded=False):
     if st.button("重置/初始化数据库"):
         init_db()
 
-questions = load_questions()
+answers_mtime = os.path.getmtime(ANSWERS_FILE) if os.path.exists(ANSWERS_FILE) else None
+questions = load_questions(answers_mtime)
 if not questions:
     st.error(f"没有找到题目配置文件 {ANSWERS_FILE}")
     st.stop()
@@ -290,21 +598,20 @@ if st.session_state.current_index >= len(questions):
 # 题目选择
 solved_ids = get_solved_questions()
 marked_ids = get_marked_questions()
-question_titles = []
-for q in questions:
-    prefix = "✅ " if q['id'] in solved_ids else ""
-    marker = "⚠️ " if q['id'] in marked_ids else ""
-    question_titles.append(f"{marker}{prefix}{q['id'] + 1}. {q['title']}")
+question_titles = build_question_titles(answers_mtime, frozenset(solved_ids), frozenset(marked_ids))
 
 def prev_question():
+    flush_history()
     if st.session_state.current_index > 0:
         st.session_state.current_index -= 1
 
 def next_question():
+    flush_history()
     if st.session_state.current_index < len(questions) - 1:
         st.session_state.current_index += 1
 
 def update_index():
+    flush_history()
     # Find index based on selected title
     st.session_state.current_index = question_titles.index(st.session_state.question_list)
 
@@ -372,10 +679,18 @@ with col1:
         run_clicked = st.button("运行", key=f"run_{current_q['id']}", width='stretch')
     with col_submit:
         submit_clicked = st.button("提交", key=f"submit_{current_q['id']}", type="primary", width='stretch')
+    # 运行时默认只读取前 11 行；勾选后额外执行一次 COUNT(*) 得到总行数
+    count_rows = st.checkbox("运行时统计总行数", key=f"count_rows_{current_q['id']}")
 
     if run_clicked or submit_clicked:
         if user_sql.strip():
-            user_df, error = run_query(user_sql)
+            if submit_clicked:
+                # 提交时流式读取完整结果用于比对，只保留前 11 行用于展示
+                user_df, row_count, user_fingerprint, error = run_query_summary(user_sql)
+            else:
+                # 仅运行时只读取展示所需的前 11 行
+                user_df, error = run_query(user_sql, max_rows=11)
+                row_count = None
             is_correct = False
             error_msg = error
             
@@ -387,51 +702,45 @@ with col1:
                 
                 # 处理重复列名，防止 st.dataframe 报错
                 if len(display_user_df.columns) != len(set(display_user_df.columns)):
-                    new_cols = []
-                    seen = set()
-                    for col in display_user_df.columns:
-                        c = col
-                        i = 1
-                        while c in seen:
-                            c = f"{col}.{i}"
-                            i += 1
-                        seen.add(c)
-                        new_cols.append(c)
-                    display_user_df.columns = new_cols
+                    display_user_df.columns = dedup_columns(display_user_df.columns)
 
                 st.dataframe(display_user_df, width='stretch')
                 
                 if len(user_df) > 10:
-                    st.caption(f"显示前 10 行 (共 {len(user_df)} 行)")
+                    if row_count is not None:
+                        st.caption(f"显示前 10 行 (共 {row_count} 行)")
+                    elif count_rows:
+                        total_rows, count_error = count_query_rows(user_sql)
+                        if count_error:
+                            st.caption(f"显示前 10 行 (无法统计总行数: {count_error})")
+                        else:
+                            st.caption(f"显示前 10 行 (共 {total_rows} 行)")
+                    else:
+                        st.caption("显示前 10 行")
                 else:
                     st.caption(f"共 {len(user_df)} 行")
                 
                 # 只有点击提交按钮时才进行比对和保存记录
                 if submit_clicked:
-                    # 简单的结果比对 (Compare full dataframes, not just displayed ones)
+                    # 简单的结果比对 (Compare full results, not just displayed ones)
                     if current_q['answer_sql']:
-                        expected_df, expected_error = run_query_with_timeout(current_q['answer_sql'])
+                        expected, expected_error = get_expected_fingerprint(current_q['answer_sql'])
                         
                         if expected_error == "Timeout":
                             st.warning("参考答案加载超时，本次提交不进行判题，仅保存记录。")
                             error_msg = "Reference answer timeout, validation skipped."
-                        elif expected_df is not None:
+                        elif expected_error:
+                            st.warning(f"参考答案执行出错，本次提交不进行判题，仅保存记录: {expected_error}")
+                            error_msg = f"Reference answer error, validation skipped: {expected_error}"
+                        elif expected is not None:
                             try:
-                                # 忽略列名进行比对：统一重命名列名为索引
-                                expected_df.columns = range(len(expected_df.columns))
-                                user_df.columns = range(len(user_df.columns))
-
-                                # Sort and compare
-                                pd.testing.assert_frame_equal(
-                                    expected_df.sort_values(by=list(expected_df.columns)).reset_index(drop=True),
-                                    user_df.sort_values(by=list(user_df.columns)).reset_index(drop=True),
-                                    check_dtype=False
-                                )
-                                st.toast("✅ 结果正确！")
-                                is_correct = True
-                            except AssertionError:
-                                st.toast("❌ 结果与预期不完全一致，请检查数据或排序。")
-                                error_msg = "Result mismatch"
+                                # 忽略列名与行顺序，按行多重集合的指纹比对
+                                if results_match(expected, user_df, user_fingerprint):
+                                    st.toast("✅ 结果正确！")
+                                    is_correct = True
+                                else:
+                                    st.toast("❌ 结果与预期不完全一致，请检查数据或排序。")
+                                    error_msg = "Result mismatch"
                             except Exception as e:
                                 st.toast(f"⚠️ 无法自动比对结果: {e}")
                                 error_msg = str(e)
@@ -452,12 +761,23 @@ with col2:
         
         selected_table = st.selectbox("预览表数据", table_list)
         if selected_table:
-            # 使用缓存的表数据
-            df = get_table_data(selected_table)
+            # 使用缓存的表数据；本连接的写入（重置数据库）由 init_db 清空缓存
+            try:
+                data_version = get_data_version()
+                df = get_table_data(selected_table, data_version)
+            except Exception as e:
+                st.error(f"读取表 {selected_table} 失败: {e}")
+                df = pd.DataFrame()
             if not df.empty:
                 st.dataframe(df.head(10), width='stretch')
                 if len(df) > 10:
-                    st.caption(f"显示前 10 行 (共 {len(df)} 行)")
+                    if st.checkbox("统计总行数", key=f"count_{selected_table}"):
+                        try:
+                            st.caption(f"显示前 10 行 (共 {get_table_count(selected_table, data_version)} 行)")
+                        except Exception as e:
+                            st.error(f"统计表 {selected_table} 行数失败: {e}")
+                    else:
+                        st.caption("显示前 10 行")
                 else:
                     st.caption(f"共 {len(df)} 行")
     else:
@@ -470,14 +790,25 @@ col3, col4 = st.columns([split_ratio, 1-split_ratio])
 
 with col3:
     st.subheader("提交记录")
-    history_df = get_history(current_q['id'])
-    if not history_df.empty:
-        for _, row in history_df.iterrows():
-            status_icon = "✅" if row['is_correct'] else "❌"
-            with st.expander(f"{status_icon} {row['timestamp']}"):
-                st.code(row['user_sql'], language='sql')
-                if not row['is_correct'] and row['error_message']:
-                    st.error(f"Error: {row['error_message']}")
+    history_rows = get_history(current_q['id'])
+    if history_rows:
+        # 整个记录列表作为一个表格渲染，而不是每条记录一个 expander
+        history_df = pd.DataFrame(history_rows, columns=["SQL", "is_correct", "错误信息", "时间"])
+        history_df.insert(0, "状态", np.where(history_df["is_correct"].astype(bool), "✅", "❌"))
+        st.dataframe(history_df[["状态", "时间", "SQL", "错误信息"]], width='stretch', hide_index=True)
+
+        # 只展开选中的一条记录。选项是按位置排列的，新提交会插到最前面，
+        # 因此 key 中带上记录条数：记录增加时重置选择，避免选中项悄悄变成另一条提交
+        selected_hist = st.selectbox(
+            "查看提交详情",
+            range(len(history_rows)),
+            format_func=lambda i: f"{history_df.at[i, '状态']} {history_df.at[i, '时间']}",
+            key=f"history_{current_q['id']}_{len(history_rows)}"
+        )
+        hist_sql, hist_correct, hist_error, hist_time = history_rows[selected_hist]
+        st.code(hist_sql, language='sql')
+        if not hist_correct and hist_error:
+            st.error(f"Error: {hist_error}")
     else:
         st.caption("暂无历史记录")
 
@@ -485,7 +816,7 @@ with col4:
     st.subheader("预期结果 (参考答案)")
     if current_q['answer_sql']:
         if st.checkbox("显示预期结果", value=True):
-            expected_df, error = run_query_with_timeout(current_q['answer_sql'])
+            expected_df, error = get_expected_result(current_q['answer_sql'])
             if error == "Timeout":
                 st.warning("答案暂时无法加载")
             elif error:
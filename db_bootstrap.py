@@ -0,0 +1,12 @@
+import re
+
+# 预编译 SQL 脚本预处理用到的正则
+_RE_USE = re.compile(r'use\s+school\s*;', re.IGNORECASE)
+_RE_DROP = re.compile(r'drop\s+table\s+(\w+);', re.IGNORECASE)
+
+def preprocess(sql):
+    """把 school/*.sql 中的 MySQL 脚本转换为 SQLite 可执行的脚本"""
+    # Remove 'use school;' which is not supported in SQLite
+    sql = _RE_USE.sub('', sql)
+    # Add IF EXISTS to DROP TABLE
+    return _RE_DROP.sub(r'DROP TABLE IF EXISTS \1;', sql)
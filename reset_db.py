@@ -1,6 +1,7 @@
 import sqlite3
 import os
-import re
+
+from db_bootstrap import preprocess
 
 DB_FILE = 'review.db'
 SQL_DIR = 'school'
@@ -19,14 +20,8 @@ def init_db():
             if os.path.exists(file_path):
                 print(f"Processing {sql_file}...")
                 with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    # Read file content
-                    content = f.read()
-                    
-                    # Remove 'use school;' which is not supported in SQLite
-                    content = re.sub(r'use\s+school\s*;', '', content, flags=re.IGNORECASE)
-                    
-                    # Add IF EXISTS to DROP TABLE
-                    content = re.sub(r'drop\s+table\s+(\w+);', r'DROP TABLE IF EXISTS \1;', content, flags=re.IGNORECASE)
+                    # Read file content and convert it for SQLite
+                    content = preprocess(f.read())
                     
                     # Execute the script
                     cursor.executescript(content)